@@ -0,0 +1,127 @@
+#  Copyright  2017 EasyStack, Inc
+
+"""Named in-memory cache regions
+
+Every region has its own TTL and LRU size bound, is safe to share
+between threads and greenthreads, and records hit/miss/eviction stats.
+The TTL and size of a region can be overridden in the [cache] section of
+skynet.conf by <region>_ttl and <region>_max_size, 0 disables them.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from skynet.common import CONF
+
+
+LOG = logging.getLogger(__name__)
+
+_REGIONS = {}
+_REGIONS_LOCK = threading.Lock()
+
+
+class CacheRegion(object):
+    """A named cache region
+
+    @param ttl: seconds a value is kept, None keeps it until evicted
+    @param max_size: max values kept, the least recently used value is
+                     evicted beyond it, None means no bound
+    """
+    def __init__(self, name, ttl=None, max_size=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expire time, value), in LRU order
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _NOTHING) is not _NOTHING
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] is not None and entry[0] <= time.time():
+                self.misses += 1
+                self.evictions += 1
+                return default
+            # the most recently used goes to the end
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expire_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expire_at, value)
+            while self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def purge(self):
+        """Evict the expired values"""
+        now = time.time()
+        with self._lock:
+            for key, (expire_at, _value) in self._data.items():
+                if expire_at is not None and expire_at <= now:
+                    del self._data[key]
+                    self.evictions += 1
+
+    def stats(self):
+        return {"size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+_NOTHING = object()
+
+
+def get_region(name, ttl=None, max_size=None):
+    """Get or create a cache region
+
+    The ttl and max_size are defaults, the [cache] options win over them.
+    """
+    with _REGIONS_LOCK:
+        if name not in _REGIONS:
+            conf = CONF()
+            # 0 means no TTL or no size bound
+            ttl = float(conf.get_option("cache", "%s_ttl" % name, ttl or 0))
+            max_size = int(conf.get_option("cache", "%s_max_size" % name,
+                                           max_size or 0))
+            _REGIONS[name] = CacheRegion(name,
+                                         ttl=ttl or None,
+                                         max_size=max_size or None)
+        return _REGIONS[name]
+
+
+def clear_all():
+    for region in _REGIONS.values():
+        region.clear()
+
+
+def log_stats():
+    for name, region in sorted(_REGIONS.items()):
+        region.purge()
+        LOG.info("Cache region %s: %s" % (name, region.stats()))
@@ -13,6 +13,7 @@ from ceilometerclient.v2 import client as clm_clientv20
 from keystoneauth1 import session
 from keystoneauth1.identity import v3
 from novaclient import client as nova_client
+import requests
 
 from skynet import utils
 
@@ -179,21 +180,45 @@ class CONF(object):
         value = None
         try:
             value = self.conf.get(group, name, raw=raw)
-        except NoOptionError or NoSectionError:
+        except (NoOptionError, NoSectionError):
             if default is not None:
                 return default
             else:
                 raise
         return value
 
+    def get_bool_option(self, group, name, default=False):
+        value = self.get_option(group, name, default)
+        if isinstance(value, bool):
+            return value
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
 
 class OpenStackClients(object):
     """Class for get some OpenStack clients
     """
     def __init__(self, conf):
         self.conf = conf
+        self._session = None
+        self._auth = None
+        self._auth_state = None
         self._nv_client = None
         self._clm_client = None
+        self.interface = conf.get_option('keystone_authtoken',
+                                         'endpoint_type',
+                                         'public')
+        self.region_name = conf.get_option('keystone_authtoken',
+                                           'region_name',
+                                           '')
+        self.token_cache = conf.get_option('keystone_authtoken',
+                                           'token_cache',
+                                           '')
+
+    @property
+    def session(self):
+        if not self._session:
+            self._session = self.get_session()
+        return self._session
 
     @property
     def nv_client(self):
@@ -207,10 +232,14 @@ class OpenStackClients(object):
             self._clm_client = self.get_ceilometerclient()
         return self._clm_client
 
-    def get_novaclient(self):
-        """Compute(nova) client
+    def get_session(self):
+        """Keystone session shared by all the clients
+
+        The clients share its token and its pooled HTTP connections. With
+        token_cache, the token is loaded from the file and reused until it
+        expires, also across restarts.
         """
-        auth = v3.Password(
+        self._auth = v3.Password(
             auth_url=self.conf.get_option(
                 'keystone_authtoken',
                 'auth_url'),
@@ -229,35 +258,64 @@ class OpenStackClients(object):
             project_domain_name=self.conf.get_option(
                 'keystone_authtoken',
                 'project_domain_name'),)
+        self._load_auth_state()
+        pool_size = int(self.conf.get_option('keystone_authtoken',
+                                             'http_pool_size',
+                                             10))
+        http = requests.Session()
+        for prefix in ('http://', 'https://'):
+            http.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size))
+        return session.Session(auth=self._auth, session=http)
+
+    def _load_auth_state(self):
+        if not self.token_cache or \
+           not hasattr(self._auth, 'set_auth_state'):
+            return
+        try:
+            with open(self.token_cache) as f:
+                self._auth_state = f.read()
+            self._auth.set_auth_state(self._auth_state)
+        except (IOError, ValueError) as e:
+            LOG.warning("Can't load keystone token from %s: %s"
+                        % (self.token_cache, e))
+            self._auth_state = None
+
+    def save_auth_state(self):
+        """Save the keystone token to token_cache if it has changed"""
+        if not self.token_cache or self._auth is None or \
+           not hasattr(self._auth, 'get_auth_state'):
+            return
+        state = self._auth.get_auth_state()
+        if not state or state == self._auth_state:
+            return
+        tmp = "%s.tmp" % self.token_cache
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(state)
+            os.rename(tmp, self.token_cache)
+            self._auth_state = state
+        except (IOError, OSError) as e:
+            LOG.warning("Can't save keystone token to %s: %s"
+                        % (self.token_cache, e))
+
+    def get_novaclient(self):
+        """Compute(nova) client
+        """
         return nova_client.Client(
             2.1,
-            session=session.Session(auth=auth)
+            session=self.session,
+            endpoint_type=self.interface,
+            region_name=self.region_name or None
             )
 
     def get_ceilometerclient(self):
         """Telemetry(ceilometer) client
         """
-        v3_kwargs = {
-                "username": self.conf.get_option(
-                    'keystone_authtoken',
-                    'username'),
-                "password": self.conf.get_option(
-                    'keystone_authtoken',
-                    'password'),
-                "project_name": self.conf.get_option(
-                    'keystone_authtoken',
-                    'project_name'),
-                "user_domain_name": self.conf.get_option(
-                    'keystone_authtoken',
-                    'user_domain_name'),
-                "project_domain_name": self.conf.get_option(
-                    'keystone_authtoken',
-                    'project_domain_name'),
-                "auth_url": self.conf.get_option(
-                    'keystone_authtoken',
-                    'auth_url'),
-                "region_name": self.conf.get_option(
-                    'keystone_authtoken',
-                    'region_name')
-        }
-        return clm_clientv20.Client('', **v3_kwargs)
+        return clm_clientv20.Client(
+            '',
+            session=self.session,
+            interface=self.interface,
+            region_name=self.region_name or None)
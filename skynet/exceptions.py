@@ -38,6 +38,11 @@ class ZabbixAuthError(SkynetException):
     pass
 
 
+class ZabbixHTTPError(SkynetException):
+    """Bad http response from zabbix frontend"""
+    pass
+
+
 class NotImplementsError(SkynetException):
     """Method is not implemented"""
     pass
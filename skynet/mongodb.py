@@ -234,11 +234,22 @@ class Connection(object):
 
         The filter must have a meter value set.
 
+        """
+        return list(self.iter_meter_statistics(sample_filter, period,
+                                               groupby, aggregate, limit))
+
+    def iter_meter_statistics(self, sample_filter, period=None, groupby=None,
+                              aggregate=None, limit=None):
+        """Yield models.Statistics instances as they are read from the
+        cursor, without building the whole list in memory.
+
+        The filter must have a meter value set.
+
         """
         if groupby or aggregate:
             # TO DO
             # ceilometet.storage.impl_mongo.Connection.get_meter_statistics
-            return []
+            return
         aggregate = []
         if (groupby and
                 set(groupby) - set(['user_id', 'project_id',
@@ -262,9 +273,8 @@ class Connection(object):
         else:
             results = self.db[coll].find(q, sort=[('timestamp', -1)])
 
-        stats = [self._stats_result_to_model(r, groupby, aggregate)
-                 for r in results]
-        return stats
+        for r in results:
+            yield self._stats_result_to_model(r, groupby, aggregate)
 
     def _stats_result_aggregates(self, result, aggregate):
         stats_args = {}
@@ -19,6 +19,21 @@ PIPLINE_DIRS = [
 ]
 
 
+def _get_positive_int(cfg, name):
+    """Get an optional positive int option, None when not specified"""
+    if cfg.get(name) is None:
+        return None
+    try:
+        value = int(cfg[name])
+    except ValueError:
+        value = 0
+    if value <= 0:
+        msg = "%s value should > 0 cfg: %s" % (name, cfg)
+        LOG.error(msg)
+        raise PipelineException(msg, cfg)
+    return value
+
+
 class Poller(object):
     """Represents a source of samples or events."""
 
@@ -30,6 +45,16 @@ class Poller(object):
             msg = "Required field %s not specified, %s" % (err.args[0], cfg)
             LOG.error(msg)
             raise PipelineException(msg)
+        # Optional, override the interval and poller_timeout of the source
+        self.interval = _get_positive_int(cfg, 'interval')
+        self.timeout = _get_positive_int(cfg, 'timeout')
+        # Shared fetch stages the poller depends on, e.g. nova_servers,
+        # fetched once before the pollers of a cycle run
+        self.fetches = cfg.get('fetches', [])
+        if not isinstance(self.fetches, list):
+            msg = "fetches should be a list cfg: %s" % cfg
+            LOG.error(msg)
+            raise PipelineException(msg, cfg)
 
     def __str__(self):
         return "Poller name: %s, Poller method: %s" % (self.name, self.method)
@@ -60,11 +85,26 @@ class PollerSource(object):
             msg = "Interval value should > 0 cfg: %s" % cfg
             LOG.error(msg)
             raise PipelineException(msg)
+        # Optional, the [skynet] options are used when not specified
+        self.workers = _get_positive_int(cfg, 'workers')
+        self.poller_timeout = _get_positive_int(cfg, 'poller_timeout')
+        self.jitter = _get_positive_int(cfg, 'jitter')
         self.check_pollers(self.meters)
 
     def get_interval(self):
         return self.interval
 
+    def get_schedules(self):
+        """Group pollers by their polling interval
+
+        :rtype: dict, interval -> pollers polled at that interval
+        """
+        schedules = {}
+        for poller in self.pollers:
+            schedules.setdefault(poller.interval or self.interval,
+                                 []).append(poller)
+        return schedules
+
     def check_pollers(self, meters):
         pollers = set()
         for meter in meters:
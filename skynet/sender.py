@@ -0,0 +1,367 @@
+#  Copyright  2017 EasyStack, Inc
+
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_BLOCK = "block"
+
+
+class SenderQueue(object):
+    """Background stage between polling and the zabbix trapper
+
+    Polling cycles put their data into a bounded in-memory queue and
+    return at once, a background thread delivers the queued items in
+    batches. A batch is flushed when flush_items items are queued or
+    when the oldest item is flush_age seconds old, whichever comes first,
+    either policy is disabled by 0.
+
+    When the queue is full, the "drop_oldest" policy drops the oldest
+    items once the background thread has not made room within
+    DROP_GRACE seconds, and the "block" policy makes the producer wait
+    for room.
+
+    @param deliver: callable sending a list of items to zabbix
+    """
+    DROP_GRACE = 1.0
+
+    def __init__(self, deliver, max_size=10000, flush_items=1000,
+                 flush_age=5, policy=POLICY_DROP_OLDEST):
+        if policy not in (POLICY_DROP_OLDEST, POLICY_BLOCK):
+            raise ValueError("Unknown sender queue policy %s" % policy)
+        self.deliver = deliver
+        self.max_size = max_size
+        self.flush_items = flush_items
+        self.flush_age = flush_age
+        self.policy = policy
+        # (enqueue time, item)
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.dropped = 0
+        self.flushed = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def _is_due(self):
+        return len(self._items) >= self.max_size or \
+            (self.flush_items and len(self._items) >= self.flush_items)
+
+    def put(self, items):
+        now = time.time()
+        dropped = self.dropped
+        # drop_oldest gives the background thread a short grace to make
+        # room before the oldest items are dropped
+        grace_until = now + self.DROP_GRACE
+        with self._cond:
+            for item in items:
+                while len(self._items) >= self.max_size:
+                    running = self._thread is not None and \
+                        self._thread.is_alive() and not self._stopped
+                    if self.policy == POLICY_BLOCK and running:
+                        self._cond.notify_all()
+                        self._cond.wait()
+                        continue
+                    grace = grace_until - time.time()
+                    if running and grace > 0:
+                        self._cond.notify_all()
+                        self._cond.wait(grace)
+                        continue
+                    self._items.popleft()
+                    self.dropped += 1
+                self._items.append((now, item))
+                if self._is_due():
+                    self._cond.notify_all()
+            self._cond.notify_all()
+        if self.dropped > dropped:
+            LOG.warning("Zabbix sender queue is full, dropped %d oldest "
+                        "items" % (self.dropped - dropped))
+
+    def _wait_seconds(self):
+        """Seconds until a batch is due, 0 when it is due now"""
+        if not self._items:
+            return None
+        if self._stopped or self._is_due():
+            return 0
+        if not self.flush_age:
+            return None if self.flush_items else 0
+        return max(0, self._items[0][0] + self.flush_age - time.time())
+
+    def _take_batch(self):
+        with self._cond:
+            while True:
+                wait = self._wait_seconds()
+                if wait == 0:
+                    break
+                if self._stopped and not self._items:
+                    return None
+                self._cond.wait(wait)
+            size = self.flush_items or len(self._items)
+            batch = list()
+            while self._items and len(batch) < size:
+                batch.append(self._items.popleft()[1])
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                break
+            start = time.time()
+            try:
+                self.deliver(batch)
+            except Exception as e:
+                LOG.error("Failed to deliver %d zabbix sender items, "
+                          "error message: %s" % (len(batch), e))
+            self.flushed += len(batch)
+            LOG.info("Flushed %d zabbix sender items in %.3f seconds, "
+                     "queue depth: %d, dropped: %d"
+                     % (len(batch), time.time() - start,
+                        len(self._items), self.dropped))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="skynet-sender")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Flush the queued items and stop the background thread"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+class Spool(object):
+    """Append-only disk spool of undelivered zabbix sender items
+
+    Items are written one JSON record per line with a "clock" timestamp,
+    so that zabbix stores them with the time they were spooled at, not
+    the time they are replayed at. The spool is replayed in bulk, oldest
+    first, once the trapper accepts data again. When the file grows over
+    max_bytes the oldest records are evicted.
+    """
+    _locks = {}
+    _replay_locks = {}
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = self._locks.setdefault(path, threading.Lock())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._read())
+
+    def has_data(self):
+        return any(os.path.exists(path) and os.path.getsize(path) > 0
+                   for path in (self.path, self.path + ".replay"))
+
+    @staticmethod
+    def _read_file(path):
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [line for line in f if line.strip()]
+
+    def _read(self):
+        return self._read_file(self.path)
+
+    def _rewrite(self, lines, path=None):
+        path = path or self.path
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.writelines(lines)
+        os.rename(tmp, path)
+
+    def append(self, items):
+        now = time.time()
+        lines = list()
+        for item in items:
+            if "clock" not in item:
+                item = dict(item, clock=int(now),
+                            ns=int((now % 1) * 1e9))
+            lines.append(json.dumps(item, separators=(',', ':')) + "\n")
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.writelines(lines)
+            if os.path.getsize(self.path) > self.max_bytes:
+                self._evict()
+        LOG.warning("Spooled %d undelivered zabbix sender items to %s"
+                    % (len(lines), self.path))
+
+    def _evict(self):
+        lines = self._read()
+        size = sum(len(line) for line in lines)
+        evicted = 0
+        while evicted < len(lines) and size > self.max_bytes:
+            size -= len(lines[evicted])
+            evicted += 1
+        self._rewrite(lines[evicted:])
+        LOG.warning("Zabbix sender spool %s is over %d bytes, evicted %d "
+                    "oldest items" % (self.path, self.max_bytes, evicted))
+
+    def replay(self, send):
+        """Send all spooled items, oldest first
+
+        The spooled items are moved aside to <path>.replay and sent without
+        holding the spool lock, so items can be spooled meanwhile. The
+        undelivered ones are put back before them. Only one replay of a
+        spool runs at a time.
+
+        @param send: callable sending a list of items, it returns a result
+                     with the "undelivered" items
+        """
+        replaying = self._replay_locks.setdefault(self.path,
+                                                  threading.Lock())
+        if not replaying.acquire(False):
+            return None
+        try:
+            replay_path = self.path + ".replay"
+            with self._lock:
+                if os.path.exists(self.path):
+                    # left over by an interrupted replay, it is older
+                    lines = self._read_file(replay_path) + self._read()
+                    self._rewrite(lines, replay_path)
+                    os.remove(self.path)
+                lines = self._read_file(replay_path)
+            if not lines:
+                return None
+            items = list()
+            for line in lines:
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    LOG.warning("Skip broken spool record: %r" % line)
+            LOG.info("Replaying %d spooled zabbix sender items"
+                     % len(items))
+            undelivered = items
+            result = None
+            try:
+                result = send(items)
+                undelivered = result['undelivered']
+            finally:
+                with self._lock:
+                    lines = [json.dumps(item, separators=(',', ':')) + "\n"
+                             for item in undelivered]
+                    self._rewrite(lines + self._read())
+                    os.remove(replay_path)
+                    if os.path.getsize(self.path) > self.max_bytes:
+                        self._evict()
+            if undelivered:
+                LOG.warning("%d spooled zabbix sender items are still "
+                            "undelivered" % len(undelivered))
+            return result
+        finally:
+            replaying.release()
+
+
+class Deadband(object):
+    """Change suppression of sender values
+
+    The last value sent for every (host, key) is remembered and a new
+    value is skipped when it is unchanged, or when each of its numbers
+    is within the absolute or relative threshold of the last sent one.
+    A value is sent anyway when the key has been silent for max_silence
+    seconds, as a heartbeat. Values are JSON strings, so dicts and lists
+    of numbers are compared field by field.
+    """
+    def __init__(self, absolute=0.0, relative=0.0, max_silence=3600):
+        self.absolute = absolute
+        self.relative = relative
+        self.max_silence = max_silence
+        # (host, key) -> (last sent value, sent time)
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def _within(self, old, new):
+        if isinstance(old, bool) or isinstance(new, bool):
+            return old == new
+        if isinstance(old, (int, long, float)) and \
+                isinstance(new, (int, long, float)):
+            diff = abs(new - old)
+            return (diff <= self.absolute or
+                    diff <= self.relative * abs(old))
+        if isinstance(old, dict) and isinstance(new, dict):
+            return (set(old) == set(new) and
+                    all(self._within(old[k], new[k]) for k in old))
+        if isinstance(old, list) and isinstance(new, list):
+            return (len(old) == len(new) and
+                    all(self._within(o, n) for o, n in zip(old, new)))
+        return old == new
+
+    def _unchanged(self, old, new):
+        if old == new:
+            return True
+        try:
+            return self._within(json.loads(old), json.loads(new))
+        except (TypeError, ValueError):
+            return False
+
+    def filter(self, items):
+        """Return the items which should be sent"""
+        now = time.time()
+        result = list()
+        with self._lock:
+            for item in items:
+                key = (item['host'], item['key'])
+                last = self._last.get(key)
+                if last is not None and \
+                        now - last[1] < self.max_silence and \
+                        self._unchanged(last[0], item['value']):
+                    continue
+                self._last[key] = (item['value'], now)
+                result.append(item)
+        if len(result) < len(items):
+            LOG.info("Suppressed %d unchanged zabbix sender items"
+                     % (len(items) - len(result)))
+        return result
+
+
+class HashRing(object):
+    """Consistent hash ring of sender endpoints
+
+    Every node is placed on the ring by several virtual replicas, so that
+    adding or removing an endpoint only moves the keys next to it.
+    """
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self._ring = sorted((self._hash("%s-%d" % (node, i)), node)
+                            for node in self.nodes
+                            for i in range(replicas))
+        self._hashes = [h for h, _node in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_nodes(self, key):
+        """All the nodes clockwise on the ring from key
+
+        The first node owns key, the next ones take over from it in turn.
+        """
+        index = bisect.bisect(self._hashes, self._hash(key))
+        nodes = list()
+        for i in range(len(self._ring)):
+            node = self._ring[(index + i) % len(self._ring)][1]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == len(self.nodes):
+                    break
+        return nodes
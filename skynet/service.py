@@ -2,16 +2,21 @@
 
 import logging
 import json
+import random
 import time
 
+import eventlet
+from eventlet import greenpool
 from oslo_config import cfg
 from oslo_log import log
 from oslo_service import service as os_service
 
+from skynet import cache
 from skynet import common
 from skynet.common import CONF as skynet_CONF
 from skynet.mongodb import Connection as MONGO_CONN
 from skynet import pipline
+from skynet import sender
 from skynet import zabbix
 
 
@@ -27,10 +32,132 @@ class AgentManager(os_service.Service):
         self.mongo_conn = mongo_conn
         self.zabbix_hdl = zabbix_hdl
         self.pollers_mg = pollers_mg
+        self.poller_workers = int(conf.get_option("skynet",
+                                                  "poller_workers", 1))
+        self.poller_timeout = int(conf.get_option("skynet",
+                                                  "poller_timeout", 0))
+        self.polling_jitter = float(conf.get_option("skynet",
+                                                    "polling_jitter", 0))
+        self.sender_queue = None
+        if conf.get_bool_option("zabbix", "sender_async", False):
+            self.sender_queue = sender.SenderQueue(
+                self._send,
+                max_size=int(conf.get_option("zabbix",
+                                             "sender_queue_size", 10000)),
+                flush_items=int(conf.get_option("zabbix",
+                                                "sender_flush_items", 1000)),
+                flush_age=float(conf.get_option("zabbix",
+                                                "sender_flush_age", 5)),
+                policy=conf.get_option("zabbix", "sender_queue_policy",
+                                       sender.POLICY_DROP_OLDEST))
+        self.deadband = None
+        if conf.get_bool_option("zabbix", "sender_deadband", False):
+            self.deadband = sender.Deadband(
+                absolute=float(conf.get_option(
+                    "zabbix", "sender_deadband_absolute", 0)),
+                relative=float(conf.get_option(
+                    "zabbix", "sender_deadband_relative", 0)),
+                max_silence=float(conf.get_option(
+                    "zabbix", "sender_deadband_max_silence", 3600)))
 
-    def interval_task(self, pollers, meter_source):
+    def _send(self, zabbix_data):
+        return self.zabbix_hdl.socket_to_zabbix(zabbix_data)
+
+    def publish(self, zabbix_data):
+        """Send the data of a cycle, or queue it in async sender mode"""
+        if self.deadband is not None:
+            zabbix_data = self.deadband.filter(zabbix_data)
+            if not zabbix_data:
+                return
+        if self.sender_queue is not None:
+            self.sender_queue.put(zabbix_data)
+            LOG.info("Queued %d zabbix sender items, queue depth: %d"
+                     % (len(zabbix_data), len(self.sender_queue)))
+        else:
+            self._send(zabbix_data)
+
+    def _poll(self, poller, meter_source, timeout, deadline=None,
+              cycle=None):
+        """Run a poller method
+
+        The poller may run for its own timeout, or else the timeout of the
+        source, but never beyond the deadline of the cycle.
+        Return (payload, measured time), payload is None when the poller
+        fails or times out.
+        @param cycle: the cycle of zabbix_hdl.open_cycle the poller is in
+        """
+        LOG.info("Polling pollster %s in the context of %s"
+                 % (poller.name, meter_source))
+        timeout = self._remaining(poller.timeout or timeout, deadline)
+        if timeout == 0:
+            LOG.error("Pollster %s missed the deadline of its cycle, "
+                      "skip it" % poller.name)
+            return (None, None)
+        self.zabbix_hdl.use_cycle(cycle)
+        try:
+            with eventlet.Timeout(timeout):
+                payload = getattr(self.zabbix_hdl, poller.method)()
+                return (payload, time.time())
+        except eventlet.Timeout:
+            LOG.error("Pollster %s timed out after %s seconds, skip it"
+                      % (poller.name, timeout))
+        except Exception as e:
+            LOG.error("Failed to poll pollster %s, error message: %s"
+                      % (poller.name, e))
+        finally:
+            self.zabbix_hdl.use_cycle(None)
+        return (None, None)
+
+    def _remaining(self, timeout, deadline):
+        """Seconds a poll may take, None when unbounded, 0 when too late"""
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return 0
+            timeout = min(timeout or remaining, remaining)
+        return timeout or None
+
+    def _fetch_stages(self, names, timeout, deadline, cycle):
+        timeout = self._remaining(timeout, deadline)
+        if timeout == 0:
+            return
+        self.zabbix_hdl.use_cycle(cycle)
+        try:
+            with eventlet.Timeout(timeout):
+                self.zabbix_hdl.stages.get_many(names)
+        except eventlet.Timeout:
+            LOG.error("Fetching stages %s timed out after %s seconds"
+                      % (names, timeout))
+        except Exception as e:
+            # pollers get the kept error of the stages and handle it
+            LOG.error("Failed to fetch stages %s, error message: %s"
+                      % (names, e))
+        finally:
+            self.zabbix_hdl.use_cycle(None)
+
+    def _prefetch(self, pool, pollers, timeout, deadline, cycle):
+        """Start fetching the declared stages of pollers in pool
+
+        Stages of one kind are fetched together, e.g. all the
+        zabbix_items, pollers which need a stage wait for its fetch.
+        """
+        groups = {}
+        for poller in pollers:
+            for name in poller.fetches:
+                groups.setdefault(name.split("[", 1)[0], set()).add(name)
+        for names in groups.values():
+            pool.spawn_n(self._fetch_stages, sorted(names), timeout,
+                         deadline, cycle)
+
+    def interval_task(self, pollers, meter_source, interval=None,
+                      workers=None, timeout=None):
         """
         @param poller: class PollerSource instance
+        @param workers: max pollers run concurrently, default is the
+                        poller_workers option
+        @param timeout: seconds a poller may run, default is the
+                        poller_timeout option or else the interval
+        The whole cycle must end within the interval.
         """
         fake_openstack_hostname = self.conf.get_option(
             "skynet",
@@ -39,27 +166,51 @@ class AgentManager(os_service.Service):
         zabbix_data = list()
         LOG.info("Staring to poll metrics: %s", [i.name for i in pollers])
         start = time.time()
+        deadline = start + interval if interval else None
         try:
-            # check zabbix server status in every polling period
+            # cheap check of zabbix server status in every polling period,
+            # the auth token is renewed only when a call is rejected
             if not self.zabbix_hdl.is_active():
                 LOG.warn("Unable to connect to zabbix server,Retry to "
                          "create a new connection")
+                self.zabbix_hdl.http_pool.close()
                 self.zabbix_hdl = zabbix.get_zbx_handler(
                     conf=self.conf,
                     mongo_conn=self.mongo_conn)
-            for poller in pollers:
-                method = poller.method
-                LOG.info("Polling pollster %s in the context of %s"
-                         % (poller.name, meter_source))
-                payload = getattr(self.zabbix_hdl, method)()
+            workers = workers or self.poller_workers
+            timeout = timeout or self.poller_timeout or interval
+            pollers = list(pollers)
+            # pollers of this cycle share identical zabbix lookups
+            cycle = self.zabbix_hdl.open_cycle()
+            try:
+                if workers > 1:
+                    pool = greenpool.GreenPool(workers)
+                    self._prefetch(pool, pollers, timeout, deadline, cycle)
+                    payloads = list(pool.imap(
+                        lambda p: self._poll(p, meter_source, timeout,
+                                             deadline, cycle),
+                        pollers))
+                else:
+                    payloads = [self._poll(p, meter_source, timeout,
+                                           deadline, cycle)
+                                for p in pollers]
+            finally:
+                self.zabbix_hdl.close_cycle(cycle)
+            for poller, (payload, clock) in zip(pollers, payloads):
+                if payload is None:
+                    continue
+                # Stamp the sample with the time it was measured at, it
+                # may be queued, spooled and sent much later
                 data = {
                     "host": fake_openstack_hostname,
                     "key": poller.name,
-                    "value": json.dumps(payload)
+                    "value": json.dumps(payload),
+                    "clock": int(clock),
+                    "ns": int((clock % 1) * 1e9)
                 }
                 zabbix_data.append(data)
-            zabbix.clear()
-            self.zabbix_hdl.socket_to_zabbix(zabbix_data)
+            cache.log_stats()
+            self.publish(zabbix_data)
         except AttributeError as e:
             LOG.error(e.message)
         except Exception as e:
@@ -67,25 +218,63 @@ class AgentManager(os_service.Service):
         end = time.time()
         LOG.info("Total seconds spends: %s", (end - start))
 
+    def _schedule(self, source, interval, pollers, initial_delay):
+        """Poll pollers every interval seconds
+
+        A cycle which outlasts its interval is not followed by the missed
+        cycles at once, they are coalesced and polling resumes at the next
+        interval boundary.
+        """
+        time.sleep(initial_delay)
+        next_run = time.time()
+        while True:
+            self.interval_task(pollers, source.name,
+                               interval=interval,
+                               workers=source.workers,
+                               timeout=source.poller_timeout)
+            now = time.time()
+            next_run += interval
+            if now > next_run:
+                missed = int((now - next_run) // interval) + 1
+                LOG.warning("Polling %s of source %s overran its interval "
+                            "%ss by %.2f seconds, coalesce %d missed cycles"
+                            % ([p.name for p in pollers], source.name,
+                               interval, now - next_run, missed))
+                next_run += missed * interval
+            time.sleep(next_run - now)
+
     def start(self):
-        # Set shuffle time before polling task if necessary
-        # default: 0.5
-        # Should better make it configurable
+        # Shuffle the first polling of every schedule by a random jitter,
+        # so that the sources do not poll at the same time
         delay_polling_time = 0.5
-        # Add timer tasks into this list, return all timer tasks if necessary
-        poller_timers = list()
+        if self.sender_queue is not None:
+            self.sender_queue.start()
+        # Add polling threads into this list, return them if necessary
+        poller_threads = list()
         for source in self.pollers_mg.sources:
-            poller_timers.append(self.tg.add_timer(
-                source.interval,
-                self.interval_task,
-                initial_delay=delay_polling_time,
-                pollers=source.pollers,
-                meter_source=source.name))
+            jitter = source.jitter or self.polling_jitter
+            for interval, pollers in source.get_schedules().items():
+                poller_threads.append(self.tg.add_thread(
+                    self._schedule,
+                    source,
+                    interval,
+                    pollers,
+                    delay_polling_time + random.uniform(0, jitter)))
         LOG.info("********* Success to start Skynet Polling Task **********")
 
+    def stop(self, graceful=False):
+        super(AgentManager, self).stop(graceful)
+        if self.sender_queue is not None:
+            # deliver what is still queued before exiting
+            self.sender_queue.stop()
+
     def test_run_once(self):
         for source in self.pollers_mg.sources:
-            self.interval_task(source.pollers)
+            for interval, pollers in source.get_schedules().items():
+                self.interval_task(pollers, source.name,
+                                   interval=interval,
+                                   workers=source.workers,
+                                   timeout=source.poller_timeout)
 
 
 def prepare_service():
@@ -0,0 +1,50 @@
+#  Copyright  2017 EasyStack, Inc
+
+import threading
+import unittest
+
+from skynet import sender
+
+
+class SenderQueueTest(unittest.TestCase):
+
+    def _put(self, policy, flush_items=3, flush_age=0):
+        delivered = list()
+        queue = sender.SenderQueue(delivered.extend, max_size=5,
+                                   flush_items=flush_items,
+                                   flush_age=flush_age,
+                                   policy=policy)
+        queue.start()
+        producer = threading.Thread(target=queue.put, args=(range(8),))
+        producer.daemon = True
+        producer.start()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        queue.stop(5)
+        return queue, delivered
+
+    def test_block_without_flush_age(self):
+        queue, delivered = self._put(sender.POLICY_BLOCK)
+        self.assertEqual(range(8), delivered)
+        self.assertEqual(0, queue.dropped)
+
+    def test_drop_oldest_without_flush_age(self):
+        queue, delivered = self._put(sender.POLICY_DROP_OLDEST)
+        self.assertEqual(range(8), delivered)
+        self.assertEqual(0, queue.dropped)
+
+    def test_block_when_full_before_flush_items(self):
+        queue, delivered = self._put(sender.POLICY_BLOCK, flush_items=10)
+        self.assertEqual(range(8), delivered)
+        self.assertEqual(0, queue.dropped)
+
+    def test_drop_oldest_when_full_before_flush_age(self):
+        # a full queue is flushed at once, not after flush_age
+        queue, delivered = self._put(sender.POLICY_DROP_OLDEST,
+                                     flush_items=10, flush_age=60)
+        self.assertEqual(range(8), delivered)
+        self.assertEqual(0, queue.dropped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 #  Copyright  2017 EasyStack, Inc
 
+import heapq
+import itertools
 import logging
 import time
 
@@ -57,57 +59,139 @@ def singleton(cls, *args, **kwags):
     return _singleton
 
 
-def calculate_items_usage(hypervisors, item):
-    """Calculate openstack hypervisor item usage
+# item -> (total field, used field, allocation ratio field) of hypervisors
+USAGE_ITEMS = {
+    "vcpu": ("vcpus", "vcpus_used", "cpu_allocation_ratio"),
+    "memory": ("memory_mb", "memory_mb_used", "ram_allocation_ratio"),
+    "disk": ("local_gb", "local_gb_used", "disk_allocation_ratio"),
+}
+
+
+def _usage_result(sums):
+    result = {}
+    for item, (total, used) in sums.items():
+        ratio = round(used / total, 4) if total else 0.0
+        result[item] = (total, used, ratio)
+    return result
+
+
+def calculate_usage(hypervisors):
+    """Calculate openstack hypervisor usage of all the items in one pass
 
     Due to allocation ratio of virtual CPU to physical CPU, OpenStack VMS can
     be allocated more resource(such as disk,cpu,memory) than physical.The
     calculation formula for different items:
         used_item / (total_item * item_allocation_ratio)
 
-    Note: disabled hypervisors and "ironic" type hypervisors will be filtered
-    @param hypervisors : openstack nova hypervisor instancs
-    @param item: exptected to calculation item
+    Note: the used items of disabled hypervisors are not counted and
+    "ironic" type hypervisors are filtered
+    @param hypervisors : list of zabbix.HypervisorRecord
+    @return: dict, item -> (total, used, ratio)
     """
-    def _sum_item(total, used, hp):
-        if item == "vcpu":
-            total += hp.vcpus * hp.cpu_allocation_ratio
-            used += hp.vcpus_used
-        elif item == "memory":
-            total += hp.memory_mb * hp.ram_allocation_ratio
-            used += hp.memory_mb_used
-        else:
-            # Additional items will be token into considerarion
-            pass
-        return (total, used)
-    item_total = 0
-    item_used = 0
-    item_ratio = 0.0
+    sums = dict((item, [0, 0]) for item in USAGE_ITEMS)
     if not isinstance(hypervisors, list):
-        return (item_total, item_used, item_ratio)
-    else:
-        for hp in hypervisors:
-            if hp.hypervisor_type == "ironic":
-                # Due to "ironic" type of hypervisor driver,
-                # Skip to calculate those values
-                continue
-            elif hp.status == "disable":
-                # When the hypervisor is disable,
-                # The total items should be included
-                hp.vcpu_used = 0
-                hp.memory_mb_used = 0
-                item_total, item_used = _sum_item(item_total,
-                                                  item_used,
-                                                  hp)
-            elif hp.state in ["up", "down"]:
-                item_total, item_used = _sum_item(item_total,
-                                                  item_used,
-                                                  hp)
-            else:
-                # Maybe more scenarios should be token into consideration.
-                pass
-    item_ratio = round(item_used / item_total, 4)
-    return (item_total, item_used, item_ratio)
+        return _usage_result(sums)
+    for hp in hypervisors:
+        if hp.hypervisor_type == "ironic":
+            # Due to "ironic" type of hypervisor driver,
+            # Skip to calculate those values
+            continue
+        elif hp.status == "disable":
+            # When the hypervisor is disable,
+            # The total items should be included, the used ones not
+            enabled = False
+        elif hp.state in ["up", "down"]:
+            enabled = True
+        else:
+            # Maybe more scenarios should be token into consideration.
+            continue
+        for item, (total, used, ratio) in USAGE_ITEMS.items():
+            sums[item][0] += getattr(hp, total) * getattr(hp, ratio)
+            if enabled:
+                sums[item][1] += getattr(hp, used)
+    return _usage_result(sums)
+
+
+def uniform_allocation_ratios(hypervisors):
+    """Return the allocation ratios shared by all the hypervisors
+
+    They are only returned when nova hypervisor statistics, which sums
+    the enabled hypervisors, can replace the detailed listing: every
+    hypervisor is enabled, up or down, not "ironic", and has the same
+    allocation ratio of each item as the others.
+    @return: dict, item -> ratio, plus "count" of hypervisors, or None
+    """
+    ratios = None
+    for hp in hypervisors:
+        if hp.hypervisor_type == "ironic" or hp.status != "enabled" or \
+           hp.state not in ["up", "down"]:
+            return None
+        hp_ratios = dict((item, getattr(hp, fields[2]))
+                         for item, fields in USAGE_ITEMS.items())
+        if ratios is None:
+            ratios = hp_ratios
+        elif ratios != hp_ratios:
+            return None
+    if ratios is not None:
+        ratios["count"] = len(hypervisors)
+    return ratios
+
+
+def calculate_statistics_usage(statistics, ratios):
+    """Calculate the usage of all the items from nova hypervisor statistics
+
+    @param statistics: nova hypervisor statistics
+    @param ratios: allocation ratios from uniform_allocation_ratios
+    @return: dict, item -> (total, used, ratio)
+    """
+    sums = {}
+    for item, (total, used, _ratio) in USAGE_ITEMS.items():
+        sums[item] = (getattr(statistics, total) * ratios[item],
+                      getattr(statistics, used))
+    return _usage_result(sums)
+
+
+class TopK(object):
+    """Streaming top-k selection
+
+    Values are pushed one by one as they arrive, e.g. from a Zabbix
+    response or a Mongo cursor, and every selection only keeps k of them
+    in a heap, so n values cost O(n log k) and are never sorted as a whole.
+    Several selections can be computed in one pass, such as the top 5 and
+    the bottom 5 cpu util:
+
+        selector = TopK({"top": (5, True), "bottom": (5, False)})
+        for vm, cpu_util in samples:
+            selector.push(cpu_util, vm)
+        selector.result("top")
+
+    @param selections: dict, name -> (k, largest), largest is True for the
+                       k largest values and False for the k smallest ones
+    """
+    def __init__(self, selections):
+        self.selections = selections
+        self.heaps = dict((name, []) for name in selections)
+        self.count = 0
+        self._seq = itertools.count()
+
+    def push(self, value, item):
+        self.count += 1
+        seq = next(self._seq)
+        for name, (k, largest) in self.selections.items():
+            heap = self.heaps[name]
+            # heapq is a min heap, the root is the worst value kept so far
+            entry = (value if largest else -value, seq, item)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry[0] > heap[0][0]:
+                heapq.heapreplace(heap, entry)
+
+    def result(self, name):
+        """Return the (value, item) pairs of a selection, best first"""
+        largest = self.selections[name][1]
+        return [(value if largest else -value, item)
+                for value, _seq, item in sorted(self.heaps[name],
+                                                key=lambda e: (-e[0], e[1]))]
 
 
 class Retry(object):
@@ -1,38 +1,241 @@
 #  Copyright  2017 EasyStack, Inc
 
-import copy
 import datetime
+import errno
+import httplib
 import json
 import logging
+import os
+import Queue
+import re
 import socket
 import struct
-import urllib2
+import threading
+import time
+import urllib
+import zlib
 
+from skynet import cache
 from skynet.common import CONF
 from skynet import exceptions
 from skynet.common import OpenStackClients
+from skynet import sender
 from skynet import utils
 
 
 LOG = logging.getLogger(__name__)
 
-HOST_CACHED = {}
-VMS_CACHED = {}
-HYPERVISOR_DETAILS = []
-
-
 Conf = CONF()
 ZBX_MAX_RETRIES = int(Conf.get_option('zabbix', 'http_max_retries', 5))
 ZBX_MAX_RETRIES_INTERVAL = int(Conf.get_option('zabbix',
                                                'http_retries_interval',
                                                8))
 
+# hostid -> host name
+HOST_NAMES = cache.get_region(
+    "host_names",
+    ttl=int(Conf.get_option("zabbix", "host_name_ttl", 3600)),
+    max_size=100000)
+
+# "ratios" -> the allocation ratios shared by all nova hypervisors, or
+# None when they are not shared
+HYPERVISOR_RATIOS = cache.get_region("hypervisor_ratios", ttl=3600)
+
+_MISSING = object()
+
+
+class VMRecord(object):
+    """The fields of a nova instance used by the pollers"""
+    __slots__ = ("id", "name", "status")
+
+    def __init__(self, server_id, name, status):
+        self.id = server_id
+        self.name = name
+        # a few distinct statuses are shared by all the records
+        self.status = intern(str(status))
+
+
+class HypervisorRecord(object):
+    """The fields of a nova hypervisor used by the pollers"""
+    __slots__ = ("hypervisor_hostname", "hypervisor_type", "status",
+                 "state", "vcpus", "vcpus_used", "memory_mb",
+                 "memory_mb_used", "local_gb", "local_gb_used",
+                 "cpu_allocation_ratio", "ram_allocation_ratio",
+                 "disk_allocation_ratio")
+    STRINGS = ("hypervisor_type", "status", "state")
+
+    def __init__(self, hypervisor):
+        for name in self.__slots__:
+            # nova without the allocation ratio fields of hypervisors
+            # does not overcommit
+            value = getattr(hypervisor, name,
+                            1.0 if name.endswith("_ratio") else None)
+            if name in self.STRINGS and value is not None:
+                value = intern(str(value))
+            setattr(self, name, value)
+
 
 def clear(is_all=False):
+    """Drop all the cached data with is_all
+
+    Cached values expire by the TTL of their cache region, nothing needs
+    to be dropped between the polling cycles.
+    """
     if is_all:
-        HOST_CACHED.clear()
-    VMS_CACHED.clear()
-    del HYPERVISOR_DETAILS[:]
+        cache.clear_all()
+
+
+class ZabbixSender(object):
+    """Zabbix trapper sender
+
+    Implements the sender protocol of zabbix_sender: every packet is
+    framed by the "ZBXD" header, a flags byte and the little-endian data
+    length and reserved fields. Large data lists are split into chunks
+    which respect max_items and max_bytes, every chunk is sent by one
+    connection, and the info string of the responses is parsed into
+    processed/failed/total counts.
+
+    With compress, packets larger than compress_threshold bytes are zlib
+    compressed (flags 0x03), the reserved field then carries the size of
+    the uncompressed data. It needs Zabbix server or proxy 4.0 or newer.
+    """
+    HEADER = "ZBXD"
+    FLAG_PROTOCOL = 0x01
+    FLAG_COMPRESS = 0x02
+    INFO_PATTERN = re.compile(r"processed:\s*(\d+);\s*failed:\s*(\d+);"
+                              r"\s*total:\s*(\d+);"
+                              r"\s*seconds spent:\s*([\d.]+)")
+
+    def __init__(self, host, port=10051, timeout=3,
+                 max_items=1000, max_bytes=16 * 1024 * 1024,
+                 compress=False, compress_threshold=1024):
+        self.host = host
+        self.port = int(port)
+        self.timeout = float(timeout)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+
+    def set_proxy_head(self, data):
+        """simplify constructing the protocol to communicate with Zabbix"""
+        body = json.dumps(data)
+        flags = self.FLAG_PROTOCOL
+        reserved = 0
+        if self.compress and len(body) >= self.compress_threshold:
+            flags |= self.FLAG_COMPRESS
+            reserved = len(body)
+            body = zlib.compress(body)
+        return (self.HEADER + chr(flags) +
+                struct.pack('<II', len(body), reserved) + body)
+
+    @staticmethod
+    def _recv_all(ss, length):
+        chunks = list()
+        while length > 0:
+            chunk = ss.recv(length)
+            if not chunk:
+                raise socket.error("Connection closed by zabbix server")
+            chunks.append(chunk)
+            length -= len(chunk)
+        return "".join(chunks)
+
+    def connect_zabbix(self, payload):
+        """Send a framed packet and return the decoded response
+
+        Raise socket.error when the packet can not be delivered.
+        """
+        ss = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            ss.sendall(payload)
+            # read socket response, the five bytes are the head msg
+            response_head = self._recv_all(ss, 5)
+            if response_head[:4] != self.HEADER:
+                raise socket.error("Got invalid response header %r"
+                                   % response_head)
+            flags = ord(response_head[4])
+            # read the data head to get the length of response
+            (response_len, _reserved) = struct.unpack(
+                '<II', self._recv_all(ss, 8))
+            response_raw = self._recv_all(ss, response_len)
+            if flags & self.FLAG_COMPRESS:
+                response_raw = zlib.decompress(response_raw)
+            return json.loads(response_raw)
+        finally:
+            ss.close()
+
+    def split(self, items):
+        """Split items into chunks which respect max_items and max_bytes"""
+        chunk = list()
+        chunk_bytes = 0
+        for item in items:
+            item_bytes = len(json.dumps(item)) + 1
+            if chunk and ((self.max_items and
+                           len(chunk) >= self.max_items) or
+                          chunk_bytes + item_bytes > self.max_bytes):
+                yield chunk
+                chunk = list()
+                chunk_bytes = 0
+            chunk.append(item)
+            chunk_bytes += item_bytes
+        if chunk:
+            yield chunk
+
+    @classmethod
+    def parse_info(cls, response):
+        """Parse the info string of a response into a dict"""
+        match = cls.INFO_PATTERN.search(response.get('info', ''))
+        if not match:
+            return None
+        return {"processed": int(match.group(1)),
+                "failed": int(match.group(2)),
+                "total": int(match.group(3)),
+                "seconds_spent": float(match.group(4))}
+
+    def send(self, items):
+        """Send items, return the summed results of all chunks
+
+        Items of chunks which could not be delivered are returned in
+        "undelivered" of the result. After a connection failure the
+        remaining chunks are not tried.
+        """
+        result = {"processed": 0, "failed": 0, "total": 0,
+                  "seconds_spent": 0.0, "chunks": 0, "undelivered": []}
+        chunks = list(self.split(items))
+        for index, chunk in enumerate(chunks):
+            result['chunks'] += 1
+            # Zabbix corrects the item clocks by the difference between
+            # its own time and the clock of the request
+            now = time.time()
+            payload = self.set_proxy_head({"request": "sender data",
+                                           "data": chunk,
+                                           "clock": int(now),
+                                           "ns": int((now % 1) * 1e9)})
+            try:
+                response = self.connect_zabbix(payload)
+            except (socket.timeout, socket.error) as err:
+                # The endpoint is down, do not connect again for the
+                # remaining chunks
+                LOG.error("Socket connect to server(%s) port(%s) failed,"
+                          "socket error: %s" % (self.host, self.port, err))
+                for rest in chunks[index:]:
+                    result['undelivered'].extend(rest)
+                break
+            except (ValueError, zlib.error) as err:
+                LOG.error("Bad response of server(%s) port(%s): %s"
+                          % (self.host, self.port, err))
+                result['undelivered'].extend(chunk)
+                continue
+            info = self.parse_info(response)
+            if response.get('response') != "success" or info is None:
+                LOG.error("Zabbix server(%s) rejected sender data: %s"
+                          % (self.host, response))
+                result['failed'] += len(chunk)
+                result['total'] += len(chunk)
+                continue
+            for field in ("processed", "failed", "total", "seconds_spent"):
+                result[field] += info[field]
+        return result
 
 
 class ZabbixBase(object):
@@ -51,107 +254,671 @@ class ZabbixBase(object):
         self.socket_timeout = conf.get_option("zabbix", "socket_timeout",
                                               default=3)
         self.conf = conf
+        # Zabbix servers or proxies receiving sender data, default is
+        # the zabbix_host
+        endpoints = conf.get_option("zabbix", "sender_endpoints", "")
+        endpoints = [ep.strip() for ep in endpoints.split(',') if ep.strip()]
+        if not endpoints:
+            endpoints = ["%s:%s" % (self.zabbix_host, self.zabbix_port)]
+        self.senders = dict()
+        for endpoint in endpoints:
+            host, _sep, port = endpoint.partition(':')
+            self.senders[endpoint] = ZabbixSender(
+                host,
+                port or 10051,
+                timeout=self.socket_timeout,
+                max_items=int(conf.get_option("zabbix", "sender_max_items",
+                                              1000)),
+                max_bytes=int(conf.get_option("zabbix", "sender_max_bytes",
+                                              16 * 1024 * 1024)),
+                compress=conf.get_bool_option("zabbix", "sender_compress",
+                                              False),
+                compress_threshold=int(conf.get_option(
+                    "zabbix", "sender_compress_threshold", 1024)))
+        self.sender_ring = sender.HashRing(endpoints)
+        # Items of a zabbix host stay on one endpoint unless "key" is
+        # configured, every endpoint must accept the host anyway
+        self.sender_shard_by = conf.get_option("zabbix", "sender_shard_by",
+                                               "host")
+        self.spool = None
+        if conf.get_bool_option("zabbix", "sender_spool", True):
+            self.spool = self._make_spool(conf)
 
-    def set_proxy_head(self, data):
-        """simplify constructing the protocol to communicate with Zabbix"""
-        # data_length = len(data)
-        # data_header = struct.pack('i', data_length) + '\0\0\0\0'
-        # HEADER = '''ZBXD\1%s%s'''
-        # data_to_send = HEADER % (data_header, data)
-        payload = json.dumps(data)
-        return payload
+    def _make_spool(self, conf):
+        spool_dir = conf.get_option("zabbix", "sender_spool_dir",
+                                    "/var/lib/skynet")
+        try:
+            if not os.path.isdir(spool_dir):
+                os.makedirs(spool_dir)
+        except OSError as e:
+            LOG.error("Unable to create sender spool dir %s, undelivered "
+                      "zabbix data will be dropped, error message: %s"
+                      % (spool_dir, e))
+            return None
+        return sender.Spool(
+            os.path.join(spool_dir, "sender.spool"),
+            max_bytes=int(conf.get_option("zabbix",
+                                          "sender_spool_max_bytes",
+                                          64 * 1024 * 1024)))
 
-    def connect_zabbix(self, payload):
-        """Send zabbix histoty data
+    def _shard_key(self, item):
+        if self.sender_shard_by == "key":
+            return "%s:%s" % (item['host'], item['key'])
+        return item['host']
+
+    def send_sharded(self, items):
+        """Route items to their endpoints and send them
+
+        Every endpoint gets its own batch. The items it can not take are
+        sent to the next endpoints clockwise on the ring.
         """
-        response = None
-        ss = None
+        batches = {}
+        for item in items:
+            endpoints = tuple(self.sender_ring.get_nodes(
+                self._shard_key(item)))
+            batches.setdefault(endpoints, []).append(item)
+        result = {"processed": 0, "failed": 0, "total": 0,
+                  "seconds_spent": 0.0, "chunks": 0, "undelivered": []}
+        for endpoints, batch in batches.items():
+            endpoint = endpoints[0]
+            for target in endpoints:
+                if target != endpoint:
+                    LOG.warning("Failover %d zabbix sender items of %s to %s"
+                                % (len(batch), endpoint, target))
+                sent = self.senders[target].send(batch)
+                for field in ("processed", "failed", "total",
+                              "seconds_spent", "chunks"):
+                    result[field] += sent[field]
+                batch = sent['undelivered']
+                if not batch:
+                    break
+            result['undelivered'].extend(batch)
+        return result
+
+    def socket_to_zabbix(self, payload=None):
+        if isinstance(payload, dict):
+            payload = [payload]
+        result = self.send_sharded(payload or [])
+        if self.spool is not None:
+            if result['undelivered']:
+                self.spool.append(result['undelivered'])
+            elif result['total'] and self.spool.has_data():
+                # The trapper has answered a real send, it is back, replay
+                # the spool in bulk
+                self.spool.replay(self.send_sharded)
+        LOG.info("Sent zabbix sender data to %s, processed: %d, "
+                 "failed: %d, total: %d, chunks: %d, undelivered: %d"
+                 % (",".join(self.sender_ring.nodes),
+                    result['processed'], result['failed'],
+                    result['total'], result['chunks'],
+                    len(result['undelivered'])))
+        return result
+
+
+class ZabbixHTTPPool(object):
+    """Keep-alive HTTP connections to the Zabbix frontend
+
+    Idle connections are kept in a bounded queue and reused by every
+    JSON-RPC call, so a polling cycle only opens a handful of sockets.
+    A reused connection may have been closed by the server meanwhile,
+    in which case the request is sent once more on a fresh connection.
+    """
+    def __init__(self, host, port, path="/zabbix/api_jsonrpc.php",
+                 pool_size=4, connect_timeout=5, read_timeout=30,
+                 gzip=False):
+        self.host = host
+        self.port = int(port)
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.gzip = gzip
+        self._idle = Queue.Queue(pool_size)
+
+    def _get_conn(self):
         try:
-            ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            ss.settimeout(int(self.socket_timeout))
-            ss.connect((self.zabbix_host, int(self.zabbix_port)))
-            # read socket response, the five bytes are the head msg
-            ss.send(payload)
-            response_head = ss.recv(5, socket.MSG_WAITALL)
-            if response_head != "ZBXD\1":
-                LOG.error("Faild to send zabbix socket data,"
-                          "got invalid response.")
-                return
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            return httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.connect_timeout)
 
-            # read the data head to get the length of response
-            response_data_head = ss.recv(8, socket.MSG_WAITALL)
-            response_data = response_data_head[:4]
-            response_len = struct.unpack('i', response_data)[0]
-
-            # read the whole rest of the response now that we know the length
-            response_raw = ss.recv(response_len, socket.MSG_WAITALL)
-            response = json.loads(response_raw)
-            LOG.info(response)
-        except (socket.timeout, socket.error) as err:
-            LOG.error("Socket connect to server(%s) port(%s) failed,"
-                      "socket error: %s" % (self.zabbix_host,
-                                            self.zabbix_port,
-                                            err))
-        finally:
-            if ss is not None:
-                ss.close()
+    def _put_conn(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+    @staticmethod
+    def _is_stale(err):
+        """Whether err shows a closed connection rather than a timeout"""
+        if isinstance(err, httplib.BadStatusLine):
+            return True
+        return (isinstance(err, socket.error) and
+                not isinstance(err, socket.timeout) and
+                err.errno in (errno.ECONNRESET, errno.EPIPE,
+                              errno.ECONNABORTED))
+
+    def request(self, payload):
+        body = json.dumps(payload)
+        headers = {'Content-Type': 'application/json',
+                   'Connection': 'keep-alive'}
+        if self.gzip:
+            headers['Accept-Encoding'] = 'gzip'
+        while True:
+            conn = self._get_conn()
+            reused = conn.sock is not None
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    conn.sock.settimeout(self.read_timeout)
+                conn.request("POST", self.path, body, headers)
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as err:
+                conn.close()
+                if reused and self._is_stale(err):
+                    # The frontend closed the idle keep-alive connection
+                    # before any reply, retry on a new one
+                    continue
+                raise
+            break
+        try:
+            data = resp.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_conn(conn)
+        if resp.status != httplib.OK:
+            raise exceptions.ZabbixHTTPError(
+                "Zabbix frontend %s:%s returned %s %s"
+                % (self.host, self.port, resp.status, resp.reason))
+        if resp.getheader('content-encoding', '').lower() == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return json.loads(data)
+
+
+class QueryCache(object):
+    """Zabbix API responses memoized within one polling cycle
+
+    Responses of read-only methods are keyed by the method plus its
+    params, so pollers of the same cycle share identical lookups such as
+    hostgroup.get or item.get.
+    """
+    def __init__(self):
+        self._responses = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(method, params):
+        return "%s:%s" % (method, json.dumps(params, sort_keys=True))
+
+    @staticmethod
+    def cacheable(method):
+        return method.endswith(".get") or method == "apiinfo.version"
+
+    def get(self, key):
+        with self._lock:
+            if key in self._responses:
+                self.hits += 1
+                return self._responses[key]
+            self.misses += 1
+        return None
+
+    def set(self, key, response):
+        if "error" in response:
+            return
+        with self._lock:
+            self._responses[key] = response
+
+
+class ZabbixSession(object):
+    """Zabbix API session
+
+    The auth token of user.login is cached and reused by all calls. The
+    liveness of the frontend is checked with apiinfo.version, which needs
+    no auth, and the session logs in again only when a call is rejected
+    because the token has expired or has been terminated.
+    """
+    AUTH_ERRORS = ("Session terminated", "Not authorised", "Not authorized")
+
+    def __init__(self, http_pool, user, password):
+        self.http_pool = http_pool
+        self.user = user
+        self.password = password
+        self.auth = None
+        # the query cache used by the current (green)thread
+        self._cycle = threading.local()
+
+    @property
+    def query_cache(self):
+        return getattr(self._cycle, "query_cache", None)
+
+    def open_cycle(self):
+        """Return the query cache of a new polling cycle
+
+        Cycles run concurrently, every (green)thread working for a cycle
+        selects its cache by use_cycle.
+        """
+        return QueryCache()
+
+    def use_cycle(self, query_cache):
+        """Use query_cache in the current (green)thread, None stops it"""
+        self._cycle.query_cache = query_cache
+
+    def close_cycle(self, query_cache):
+        LOG.info("Zabbix query cache of the cycle: %d hits, %d misses"
+                 % (query_cache.hits, query_cache.misses))
+
+    @staticmethod
+    def _payload(method, params, auth=None):
+        payload = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": 1
+        }
+        if auth:
+            payload['auth'] = auth
+        return payload
+
+    @staticmethod
+    def _no_response(call_id):
+        return {
+            "jsonrpc": "2.0",
+            "error": {"code": -32603,
+                      "message": "No response",
+                      "data": "No reply to the call in the batch"},
+            "id": call_id
+        }
+
+    def _is_auth_error(self, response):
+        if "error" not in response:
+            return False
+        data = response['error'].get('data') or ''
+        return any(err in data for err in self.AUTH_ERRORS)
+
+    def login(self):
+        response = self.http_pool.request(self._payload(
+            "user.login",
+            {"user": self.user, "password": self.password}))
+        if "error" in response:
+            msg = "Incorrect user or password, please check it again"
+            LOG.error(msg)
+            raise exceptions.ZabbixAuthError(msg)
+        self.auth = response['result']
+        return self.auth
+
+    def is_alive(self):
+        try:
+            response = self.http_pool.request(
+                self._payload("apiinfo.version", {}))
+        except Exception as err:
+            LOG.error("Zabbix server is useless. err:%s" % err)
+            return False
+        if "error" in response:
+            LOG.error("Zabbix server is useless. err:%s" % response['error'])
+            return False
+        return True
+
+    def do_request(self, method, params):
+        cache = self.query_cache
+        key = None
+        if cache is not None and cache.cacheable(method):
+            key = cache.make_key(method, params)
+            response = cache.get(key)
+            if response is not None:
+                return response
+        if not self.auth:
+            self.login()
+        response = self.http_pool.request(
+            self._payload(method, params, self.auth))
+        if self._is_auth_error(response):
+            LOG.info("Zabbix session of user %s is expired, login again"
+                     % self.user)
+            self.login()
+            response = self.http_pool.request(
+                self._payload(method, params, self.auth))
+        if key is not None:
+            cache.set(key, response)
         return response
 
-    def socket_to_zabbix(self, payload=None):
-        data = {"request": "sender data"}
-        if isinstance(payload, dict):
-            data['data'] = [payload]
-        elif isinstance(payload, list):
-            data['data'] = payload
-        payload = self.set_proxy_head(data)
-        self.connect_zabbix(payload)
+    def do_batch_request(self, calls):
+        """Send several calls as one JSON-RPC 2.0 batch
+
+        Responses are matched to the calls by their id. Calls answered by
+        the query cache of the cycle are not sent at all.
+
+        :param calls: list of (method, params)
+        :rtype: list of responses, in the order of calls
+        """
+        cache = self.query_cache
+        responses = [None] * len(calls)
+        keys = [None] * len(calls)
+        pending = list()
+        for i, (method, params) in enumerate(calls):
+            if cache is not None and cache.cacheable(method):
+                keys[i] = cache.make_key(method, params)
+                responses[i] = cache.get(keys[i])
+            if responses[i] is None:
+                pending.append(i)
+        if not pending:
+            return responses
+        if not self.auth:
+            self.login()
+        for attempt in range(2):
+            payloads = list()
+            for i in pending:
+                payload = self._payload(calls[i][0], calls[i][1], self.auth)
+                payload['id'] = i
+                payloads.append(payload)
+            results = self.http_pool.request(payloads)
+            if isinstance(results, dict):
+                # The whole batch is rejected, e.g. by an old frontend
+                results = [dict(results, id=i) for i in pending]
+            answered = dict((result.get('id'), result) for result in results
+                            if isinstance(result, dict))
+            for i in pending:
+                # a call without a reply gets the error replied with a null
+                # id, e.g. an invalid request, or else an error of its own
+                responses[i] = answered.get(i) or \
+                    dict(answered.get(None) or self._no_response(i), id=i)
+            if attempt or not any(self._is_auth_error(responses[i])
+                                  for i in pending):
+                break
+            LOG.info("Zabbix session of user %s is expired, login again"
+                     % self.user)
+            self.login()
+        for i in pending:
+            if keys[i] is not None:
+                cache.set(keys[i], responses[i])
+        return responses
+
+
+class _StageError(object):
+    """The error of a failed fetch stage"""
+    __slots__ = ("error",)
+
+    def __init__(self, error):
+        self.error = error
+
+
+class FetchStages(object):
+    """Upstream data fetched once and shared by many pollers
+
+    A stage is named like "nova_servers" or, with an argument,
+    "zabbix_items[system.cpu.util[,idle]]", and is fetched by the
+    fetch_<stage> method of the controller. Stages with an argument are
+    fetched together by one call which takes the list of arguments.
+
+    A fetched stage is kept in the cache region stage_<stage> and reused
+    for window seconds, or the [cache] stage_<stage>_ttl, so pollers of a
+    cycle, and of other sources polled about the same time, do not fetch
+    it again. Concurrent pollers wait for a single fetch of a stage. A
+    failed fetch is kept as long, pollers get its error without retrying.
+    """
+    NAME_PATTERN = re.compile(r"^(\w+)(?:\[(.*)\])?$")
+
+    def __init__(self, controller, window=60):
+        self.controller = controller
+        self.window = window
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, name):
+        with self._locks_lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _region(self, name):
+        stage = self.NAME_PATTERN.match(name).group(1)
+        return cache.get_region("stage_%s" % stage, ttl=self.window)
+
+    def _fetch(self, names):
+        fetched = {}
+        groups = {}
+        for name in names:
+            match = self.NAME_PATTERN.match(name)
+            if not match:
+                raise exceptions.SkynetException("Invalid fetch stage %s"
+                                                 % name)
+            stage, arg = match.groups()
+            groups.setdefault(stage, []).append((name, arg))
+        for stage, args in groups.items():
+            fetcher = getattr(self.controller, "fetch_%s" % stage, None)
+            if fetcher is None:
+                raise exceptions.SkynetException("Unknown fetch stage %s"
+                                                 % stage)
+            region = self._region(stage)
+            try:
+                if args[0][1] is None:
+                    values = [fetcher()]
+                else:
+                    values = fetcher([stage_arg for _name, stage_arg in args])
+            except BaseException as e:
+                # also a timeout of the caller, e.g. eventlet.Timeout, the
+                # failure is kept so that other pollers do not retry it
+                for name, _arg in args:
+                    region.set(name, _StageError(e))
+                raise
+            for (name, _arg), value in zip(args, values):
+                region.set(name, value)
+                fetched[name] = value
+        return fetched
+
+    def get_many(self, names):
+        """Return dict, stage name -> fetched value"""
+        names = sorted(set(names))
+        locked = list()
+        try:
+            for name in names:
+                lock = self._lock(name)
+                lock.acquire()
+                locked.append(lock)
+            values = {}
+            missing = []
+            for name in names:
+                if not self.NAME_PATTERN.match(name):
+                    raise exceptions.SkynetException("Invalid fetch stage %s"
+                                                     % name)
+                value = self._region(name).get(name, _MISSING)
+                if value is _MISSING:
+                    missing.append(name)
+                elif isinstance(value, _StageError):
+                    raise exceptions.SkynetException(
+                        "Fetch stage %s failed recently: %r"
+                        % (name, value.error))
+                else:
+                    values[name] = value
+            if missing:
+                LOG.debug("Fetching stages %s" % missing)
+                values.update(self._fetch(missing))
+            return values
+        finally:
+            # a timeout may interrupt the waiting for a lock, only the
+            # acquired ones are released
+            for lock in locked:
+                lock.release()
+
+    def get(self, name):
+        return self.get_many([name])[name]
+
+
+class VMInventory(object):
+    """Nova instances of all tenants kept across polling cycles
+
+    The first refresh lists all the instances, the later ones only list
+    the instances changed since the previous refresh by nova changes-since,
+    deleted instances included, and apply them to the id -> VMRecord map
+    and the status -> ids index. Every resync_interval seconds the full
+    listing is done again to correct any drift.
+
+    @param list_servers: callable taking nova search_opts, returns an
+                         iterable of VMRecord
+    """
+    # Seconds the changes-since time is moved back by, for the clock skew
+    # between skynet and nova
+    CLOCK_SLACK = 60
+
+    def __init__(self, list_servers, resync_interval=3600):
+        self.list_servers = list_servers
+        self.resync_interval = resync_interval
+        # instance id -> VMRecord
+        self._servers = {}
+        # instance status -> set of instance ids
+        self._by_status = {}
+        self._synced_at = None
+        self._resynced_at = None
+        # _lock guards the maps, _refresh_lock serializes the refreshes
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._servers)
+
+    @staticmethod
+    def _put(servers, by_status, vm):
+        old = servers.pop(vm.id, None)
+        if old is not None:
+            by_status[old.status].discard(vm.id)
+        if vm.status != "DELETED":
+            servers[vm.id] = vm
+            by_status.setdefault(vm.status, set()).add(vm.id)
+
+    def refresh(self):
+        """List the instances and apply them
+
+        The listing is done without holding the lock of the maps, which
+        are only changed once it completes, so readers never see a
+        partial inventory, nor one left by a failed listing.
+        """
+        start = time.time()
+        with self._refresh_lock:
+            if self._resynced_at is None or \
+               start - self._resynced_at >= self.resync_interval:
+                servers = {}
+                by_status = {}
+                for vm in self.list_servers(None):
+                    self._put(servers, by_status, vm)
+                with self._lock:
+                    self._servers = servers
+                    self._by_status = by_status
+                self._resynced_at = start
+                LOG.info("Listed all the %d nova instances in %.3f seconds"
+                         % (len(servers), time.time() - start))
+            else:
+                since = datetime.datetime.utcfromtimestamp(
+                    self._synced_at - self.CLOCK_SLACK)
+                changed = list(self.list_servers(
+                    {"changes-since": since.strftime("%Y-%m-%dT%H:%M:%SZ")}))
+                with self._lock:
+                    for vm in changed:
+                        self._put(self._servers, self._by_status, vm)
+                LOG.debug("Applied %d changed nova instances in %.3f "
+                          "seconds" % (len(changed), time.time() - start))
+            self._synced_at = start
+        return self
+
+    def status_counts(self):
+        """Return dict, instance status -> number of instances"""
+        with self._lock:
+            return dict((status, len(ids))
+                        for status, ids in self._by_status.items() if ids)
+
+    def ids(self, status):
+        with self._lock:
+            return list(self._by_status.get(status, ()))
+
+    def name(self, server_id):
+        with self._lock:
+            vm = self._servers.get(server_id)
+        return vm.name if vm is not None else None
 
 
 class ZabbixController(ZabbixBase):
     """Zabbix controller send agent history data by socket
     """
+    # Item fields used by the host pollers
+    ITEM_OUTPUT = ["itemid", "hostid", "value_type",
+                   "lastvalue", "prevvalue", "lastclock"]
+
     def __init__(self, conf, mongo_conn):
         super(ZabbixController, self).__init__(conf)
         self.zabbix_user = conf.get_option("zabbix", "zabbix_user")
         self.zabbix_user_pwd = conf.get_option("zabbix", "zabbix_user_pwd")
         self.zabbix_web_port = conf.get_option("zabbix", "zabbix_web_port")
-        self.auth = self.get_zabbix_auth()
+        self.history_batch_size = int(conf.get_option(
+            "zabbix", "history_batch_size", 500))
+        self.history_time_window = int(conf.get_option(
+            "zabbix", "history_time_window", 3600))
+        self.history_batch_calls = int(conf.get_option(
+            "zabbix", "history_batch_calls", 4))
+        self.lastvalue_fast_path = conf.get_bool_option(
+            "zabbix", "lastvalue_fast_path", True)
+        self.lastvalue_max_age = int(conf.get_option(
+            "zabbix", "lastvalue_max_age", 600))
+        self.http_pool = ZabbixHTTPPool(
+            self.zabbix_host,
+            self.zabbix_web_port,
+            pool_size=int(conf.get_option("zabbix", "http_pool_size", 4)),
+            connect_timeout=float(conf.get_option(
+                "zabbix", "http_connect_timeout", 5)),
+            read_timeout=float(conf.get_option(
+                "zabbix", "http_read_timeout", 30)),
+            gzip=conf.get_bool_option("zabbix", "http_gzip", False))
+        self.session = ZabbixSession(self.http_pool,
+                                     self.zabbix_user,
+                                     self.zabbix_user_pwd)
+        self.get_zabbix_auth()
         self.osk_clients = OpenStackClients(conf)
         self.mongo_handler = mongo_conn
+        self.nova_page_size = int(conf.get_option(
+            "skynet", "nova_page_size", 1000))
+        self.vm_inventory = VMInventory(
+            self._list_servers,
+            resync_interval=int(conf.get_option(
+                "skynet", "nova_resync_interval", 3600)))
+        self.stages = FetchStages(
+            self,
+            window=int(conf.get_option("skynet", "fetch_stage_window", 60)))
+
+    @property
+    def auth(self):
+        return self.session.auth
 
     def get_zabbix_auth(self):
         """ Get admin credentials (user, password) from Zabbix API
         """
-        payload = {"jsonrpc": "2.0",
-                   "method": "user.login",
-                   "params": {"user": self.zabbix_user,
-                              "password": self.zabbix_user_pwd},
-                   "id": 2}
-        response = self.call_zabbix_api(payload)
-        if "error" in response:
-            msg = "Incorrect user or password, please check it again"
-            LOG.error(msg)
-            raise exceptions.ZabbixAuthError(msg)
-        return response['result']
+        return self.session.login()
 
     def is_active(self):
         """check zabbix status"""
-        try:
-            self.get_zabbix_auth()
-        except Exception as err:
-            LOG.error("Zabbix server is useless. err:%s" % err.message)
-            return False
-        return True
+        return self.session.is_alive()
 
     def call_zabbix_api(self, payload):
-        url = "http://%s:%s/zabbix/api_jsonrpc.php" % (self.zabbix_host,
-                                                       self.zabbix_web_port)
-        data = json.dumps(payload)
-        req = urllib2.Request(url, data, {'Content-Type': 'application/json'})
-        f = urllib2.urlopen(req)
-        response = json.loads(f.read())
-        f.close()
-        return response
+        return self.http_pool.request(payload)
+
+    def open_cycle(self):
+        """Return a cycle, its pollers share identical zabbix lookups
+
+        Every (green)thread polling for the cycle calls use_cycle first.
+        """
+        return self.session.open_cycle()
+
+    def use_cycle(self, cycle):
+        self.session.use_cycle(cycle)
+
+    def close_cycle(self, cycle):
+        self.session.close_cycle(cycle)
+        self.osk_clients.save_auth_state()
 
     def get_openstack_hostgroups(self):
         """Get all hosts filtered by hostgroups
@@ -161,82 +928,189 @@ class ZabbixController(ZabbixBase):
         # default is ['']
         hostgroups = self.conf.get_option("skynet", "hostgroups")
         hostgroups = [i.strip() for i in hostgroups.split(',')]
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "hostgroup.get",
-            "params": {
-                "output": "extend",
-                "filter": {
-                    "name": hostgroups}
-            },
-            "auth": self.auth,
-            "id": 1
+        params = {
+            "output": "extend",
+            "filter": {
+                "name": hostgroups}
         }
-        response = self.call_zabbix_api(payload)
+        response = self.session.do_request("hostgroup.get", params)
         if "error" in response:
             LOG.error("Bad Request:%s" % response['error'])
         return [hg['groupid'] for hg in response['result']]
 
     def get_all_hosts(self, filters=None):
-        payload = {
-                "jsonrpc": "2.0",
-                "method": "host.get",
-                "params": {
-                    "output": "extend"
-                    },
-                "auth": self.auth,
-                "id": 1
-            }
-        payload['params'].update(filters)
-        response = self.call_zabbix_api(payload)
+        params = {
+            "output": "extend"
+        }
+        params.update(filters)
+        response = self.session.do_request("host.get", params)
         return response
 
-    def get_item_by_filters(self, filters, search_key=None):
-        """Get all itemids by hostgroups and search_key
+    def get_items_by_keys(self, filters, keys, output="extend"):
+        """Get items of several keys by one batch request
 
-        :param filter:dict: refers to the zabbix hostgroup
-        :param search_key:dict: refers to the item_key,also a filter msg
-        :rtype: list
+        :param filters:dict: refers to the zabbix hostgroup
+        :param keys:list: item keys, each one is searched separately
+        :param output: item fields to return, default is all fields
+        :rtype: list of responses, in the order of keys
         """
-        payload = {
-                "jsonrpc": "2.0",
-                "method": "item.get",
-                "params": {
-                    "output": "extend"
-                    },
-                "auth": self.auth,
-                "id": 1
-        }
-        payload['params'].update(filters)
-        if search_key:
-            payload['params']['search'] = search_key
-        response = self.call_zabbix_api(payload)
-        return response
+        calls = list()
+        for key in keys:
+            params = {
+                "output": output,
+                "search": {"key_": key}
+            }
+            params.update(filters)
+            calls.append(("item.get", params))
+        return self.session.do_batch_request(calls)
 
-    def get_history(self, histoty, itemids,
-                    sortfield="clock", sortorder="DESC"):
-        payload = {
-                "jsonrpc": "2.0",
-                "method": "history.get",
-                "params": {
-                    "output": "extend",
-                    "history": histoty,
-                    "sortfield": sortfield,
-                    "sortorder": sortorder,
-                    "limit": len(itemids) if isinstance(itemids,
-                                                        list) else 1
-                    },
-                "auth": self.auth,
-                "id": 1
-        }
-        payload['params']['itemids'] = itemids
-        response = self.call_zabbix_api(payload)
-        return response
+    def fetch_zabbix_items(self, keys):
+        """Fetch stage zabbix_items[key], item.get of the openstack hosts"""
+        groupids = self.get_openstack_hostgroups()
+        filters = {"groupids": groupids, "selectHosts": ["host"]}
+        responses = self.get_items_by_keys(filters, keys, self.ITEM_OUTPUT)
+        for response in responses:
+            if "error" in response:
+                raise exceptions.SkynetException("Bad Request:%s"
+                                                 % response['error'])
+        return responses
+
+    def fetch_nova_servers(self):
+        """Fetch stage nova_servers, the refreshed VMInventory"""
+        return self.vm_inventory.refresh()
+
+    def _list_servers(self, search_opts):
+        return self.iter_servers(self.osk_clients.nv_client, search_opts)
+
+    def fetch_nova_hypervisors(self):
+        """Fetch stage nova_hypervisors, HypervisorRecord of hypervisors"""
+        return [HypervisorRecord(hp) for hp in
+                self.osk_clients.nv_client.hypervisors.list(detailed=True)]
+
+    def fetch_nova_hypervisor_usage(self):
+        """Fetch stage nova_hypervisor_usage, item -> (total, used, ratio)
+
+        When all the hypervisors share their allocation ratios, the usage is
+        calculated from nova hypervisor statistics, one small call for any
+        number of hypervisors. The ratios are taken from the detailed
+        listing and cached in the hypervisor_ratios region, the detailed
+        listing is used again once they expire, differ among hypervisors
+        or the number of hypervisors changes.
+        """
+        ratios = HYPERVISOR_RATIOS.get("ratios", _MISSING)
+        if ratios is not _MISSING and ratios is not None:
+            statistics = \
+                self.osk_clients.nv_client.hypervisor_stats.statistics()
+            if statistics.count == ratios["count"]:
+                return utils.calculate_statistics_usage(statistics, ratios)
+            LOG.info("Nova hypervisors changed from %d to %d, list them "
+                     "again" % (ratios["count"], statistics.count))
+            ratios = _MISSING
+        hypervisors = self.stages.get("nova_hypervisors")
+        if ratios is _MISSING:
+            HYPERVISOR_RATIOS.set(
+                "ratios", utils.uniform_allocation_ratios(hypervisors))
+        return utils.calculate_usage(hypervisors)
+
+    def fetch_ceilometer_alarms(self):
+        """Fetch stage ceilometer_alarms, all the ceilometer alarms"""
+        return self.osk_clients.clm_client.alarms.list()
+
+    def get_histories(self, history, items):
+        """Get the latest history value of many items at once
+
+        Items are grouped by their value type, ordered by their lastclock
+        and split into chunks of history_batch_size itemids. Every chunk
+        only searches the history since the oldest lastclock of its items,
+        where their latest values are, but never beyond the last
+        history_time_window seconds. Items which reported last before that
+        window are skipped, as are items without a lastclock which are
+        searched in the whole window. At most history_batch_calls chunks
+        are sent in one batch request.
+
+        :param history: history type used when an item has no value_type
+        :param items: item dicts returned by item.get
+        :rtype: dict, itemid -> the latest history value
+        """
+        oldest_from = int(time.time()) - self.history_time_window
+        groups = {}
+        outdated = 0
+        for item in items:
+            lastclock = int(item.get('lastclock') or 0) or oldest_from
+            if lastclock < oldest_from:
+                # e.g. a host down for long, it has no value in the window
+                outdated += 1
+                continue
+            groups.setdefault(item.get('value_type', history),
+                              []).append((lastclock, item['itemid']))
+        if outdated:
+            LOG.warning("Skip %d items which have no value in the last %d "
+                        "seconds" % (outdated, self.history_time_window))
+        calls = list()
+        for value_type, clocks in groups.items():
+            clocks.sort()
+            for i in range(0, len(clocks), self.history_batch_size):
+                chunk = clocks[i:i + self.history_batch_size]
+                calls.append(("history.get", {
+                    "output": ["itemid", "value"],
+                    "history": value_type,
+                    "itemids": [itemid for _clock, itemid in chunk],
+                    "time_from": chunk[0][0],
+                    "sortfield": "clock",
+                    "sortorder": "DESC"}))
+        latest = {}
+        for i in range(0, len(calls), self.history_batch_calls):
+            responses = self.session.do_batch_request(
+                calls[i:i + self.history_batch_calls])
+            for response in responses:
+                if "error" in response:
+                    LOG.error("Bad Request:%s" % response['error'])
+                    continue
+                # Sorted by clock DESC, the first value is the latest one
+                for his in response['result']:
+                    if his['itemid'] not in latest:
+                        latest[his['itemid']] = his['value']
+        return latest
+
+    def get_latest_values(self, history, items):
+        """Get the latest value of items returned by item.get
+
+        With lastvalue_fast_path the lastvalue of item.get is used as is,
+        history.get is only asked for items whose lastclock is older than
+        lastvalue_max_age seconds.
+
+        :param history: history type used when an item has no value_type
+        :param items: item dicts returned by item.get
+        :rtype: dict, itemid -> the latest value
+        """
+        if not self.lastvalue_fast_path:
+            return self.get_histories(history, items)
+        latest = {}
+        stale_items = list()
+        oldest_clock = int(time.time()) - self.lastvalue_max_age
+        for item in items:
+            if int(item.get('lastclock', 0)) >= oldest_clock:
+                latest[item['itemid']] = item['lastvalue']
+            else:
+                stale_items.append(item)
+        if stale_items:
+            latest.update(self.get_histories(history, stale_items))
+        return latest
 
     def create_host_total(self):
         groupids = self.get_openstack_hostgroups()
+        # The total is counted by zabbix, only the error field of
+        # monitored hosts is returned to find the active ones
+        calls = [
+            ("host.get", {"groupids": groupids,
+                          "countOutput": True}),
+            ("host.get", {"groupids": groupids,
+                          "output": ["error"],
+                          "filter": {"status": "0"}})
+        ]
         try:
-            response = self.get_all_hosts({"groupids": groupids})
+            (total_resp, monitored_resp) = \
+                self.session.do_batch_request(calls)
         except Exception as e:
             LOG.error("Failed to get all hosts in hostgroups %s,"
                       "error message: %s" % (groupids, e.message))
@@ -246,15 +1120,16 @@ class ZabbixController(ZabbixBase):
                 "active": 0,
                 "off": 0
             }
-        if "error" in response:
-            LOG.error("Bad Request:%s" % response['error'])
-            return {"total": 0,
-                    "active": 0,
-                    "off": 0}
-        total = len(response['result'])
+        for response in (total_resp, monitored_resp):
+            if "error" in response:
+                LOG.error("Bad Request:%s" % response['error'])
+                return {"total": 0,
+                        "active": 0,
+                        "off": 0}
+        total = int(total_resp['result'])
         active = 0
-        for host in response['result']:
-            if host['status'] == "0" and not host['error']:
+        for host in monitored_resp['result']:
+            if not host['error']:
                 active += 1
         return {
             "total": total,
@@ -263,27 +1138,24 @@ class ZabbixController(ZabbixBase):
 
     def create_memory_usage(self):
         def _get(total_items):
-            itemids = list()
+            items = list()
             for item in total_items['result']:
                 if int(item['lastvalue']) > 0 and int(item['prevvalue']) > 0:
-                    itemids.append(item['itemid'])
+                    items.append(item)
+            values = self.get_latest_values("3", items)
             total_mems = 0
-            for item in itemids:
-                ava_mems = self.get_history("3", item)
-                total_mems += int(ava_mems['result'][0].get("value", 0))
+            for item in items:
+                total_mems += int(values.get(item['itemid'], 0))
             return total_mems
         try:
-            groupids = self.get_openstack_hostgroups()
-            # get total memory
-            filters = {"groupids": groupids}
-            search_key = {"key_": "vm.memory.size[available]"}
-            total_items = self.get_item_by_filters(filters, search_key)
-            sum_ava_mems = _get(total_items)
-
-            # get avaliable memory
-            search_key['key_'] = "vm.memory.size[total]"
-            total_items = self.get_item_by_filters(filters, search_key)
-            sum_total_mems = _get(total_items)
+            # get avaliable and total memory in one round trip
+            stages = self.stages.get_many(
+                ["zabbix_items[vm.memory.size[available]]",
+                 "zabbix_items[vm.memory.size[total]]"])
+            sum_ava_mems = _get(
+                stages["zabbix_items[vm.memory.size[available]]"])
+            sum_total_mems = _get(
+                stages["zabbix_items[vm.memory.size[total]]"])
             return {
                 "available_mems": sum_ava_mems,
                 "total_mems": sum_total_mems,
@@ -302,24 +1174,21 @@ class ZabbixController(ZabbixBase):
 
     def create_cpu_util(self):
         def _get(total_items):
-            itemids = list()
+            items = list()
             for item in total_items['result']:
                 if float(item['lastvalue']) > 0 and\
                    float(item['prevvalue']) > 0:
-                    itemids.append(item['itemid'])
+                    items.append(item)
+            values = self.get_latest_values("7", items)
             total_cpu_util = list()
-            for item in itemids:
-                cpu_util = self.get_history("7", item)
-                total_cpu_util.append(float(cpu_util['result'][0].get(
-                                        "value",
-                                        0)))
+            for item in items:
+                if item['itemid'] in values:
+                    total_cpu_util.append(float(values[item['itemid']]))
             return total_cpu_util
         try:
-            groupids = self.get_openstack_hostgroups()
             # get total cpu_util
-            filters = {"groupids": groupids}
-            search_key = {"key_": "system.cpu.util[,idle]"}
-            total_items = self.get_item_by_filters(filters, search_key)
+            total_items = self.stages.get(
+                "zabbix_items[system.cpu.util[,idle]]")
             ideal_utils = _get(total_items)
             cpu_utils = sum([(100 - i) for i in ideal_utils])
             used_radio = round(1.0 * cpu_utils / len(ideal_utils) / 100, 4)
@@ -338,45 +1207,64 @@ class ZabbixController(ZabbixBase):
             }
 
     def _get_item_values(self, total_items):
-        items_map = {}
+        """Yield (hostid, latest value) of the items"""
+        items = list()
         for item in total_items['result']:
             if float(item['lastvalue']) > 0 \
                and float(item['prevvalue']) > 0:
-                items_map[item['itemid']] = item['hostid']
-        pavais_his = list()
-        for itemid in items_map.keys():
-            response = self.get_history("7", itemid)
-            pavais_his.append(
-                (items_map[itemid],
-                 float(response['result'][0].get("value", 0.0))))
-        return pavais_his
+                items.append(item)
+        self._remember_host_names(items)
+        values = self.get_latest_values("7", items)
+        for item in items:
+            if item['itemid'] in values:
+                yield (item['hostid'], float(values[item['itemid']]))
+
+    def _remember_host_names(self, items):
+        """Index host names joined to items by selectHosts"""
+        for item in items:
+            for host in item.get('hosts', []):
+                HOST_NAMES.set(item['hostid'], host['host'])
+
+    def get_host_names(self, hostids):
+        """Map hostids to host names
+
+        Names are kept across cycles in the host_names cache region,
+        host.get is only called for hosts which are unknown or expired.
+        """
+        names = {}
+        missing = list()
+        for hostid in hostids:
+            name = HOST_NAMES.get(hostid)
+            if name is None:
+                missing.append(hostid)
+            else:
+                names[hostid] = name
+        if missing:
+            response = self.get_all_hosts({"output": ["hostid", "host"],
+                                           "hostids": missing})
+            for host in response['result']:
+                HOST_NAMES.set(host['hostid'], host['host'])
+                names[host['hostid']] = host['host']
+        return names
 
     def create_hosts_top_memory_usage(self):
         try:
             top = int(self.conf.get_option("skynet", "top", 5))
-            groupids = self.get_openstack_hostgroups()
-            filters = {"groupids": groupids}
-            search_key = {"key_": "vm.memory.size[pavailable]"}
-            total_items = self.get_item_by_filters(filters, search_key)
-            total_pavais = self._get_item_values(total_items)
-            if len(total_pavais) > top:
-                sorted_memory_usage = sorted(total_pavais,
-                                             key=lambda i: i[1])[:top]
-            else:
+            total_items = self.stages.get(
+                "zabbix_items[vm.memory.size[pavailable]]")
+            # the least available memory first
+            selector = utils.TopK({"top": (top, False)})
+            for hostid, pavai in self._get_item_values(total_items):
+                selector.push(pavai, hostid)
+            if selector.count <= top:
                 LOG.warning("Total num of openstack physical host %d is less "
-                            "then top(%d)" % (len(total_pavais), top))
-                sorted_memory_usage = sorted(total_pavais,
-                                             key=lambda i: i[1])
-            hostid_value_map = {}
-            top_result = []
-            for i in sorted_memory_usage:
-                hostid_value_map[i[0]] = round((100 - i[1]), 2)
-            hosts = self.get_all_hosts({"hostids":
-                                        hostid_value_map.keys()})['result']
-            top_result = [{host['host']:
-                          hostid_value_map[host['hostid']]} for host in hosts]
-            top_result.sort(cmp=lambda x, y: cmp(x, y),
-                            key=lambda x: x.values()[0])
+                            "then top(%d)" % (selector.count, top))
+            ranked = selector.result("top")
+            names = self.get_host_names([hostid for _, hostid in ranked])
+            # ASC order of memory usage
+            top_result = [{names[hostid]: round((100 - pavai), 2)}
+                          for pavai, hostid in reversed(ranked)
+                          if hostid in names]
             return top_result
         except Exception as e:
             LOG.error("Failed to get openstack cluster top%d memory usage,"
@@ -389,48 +1277,55 @@ class ZabbixController(ZabbixBase):
         """
         try:
             top = int(self.conf.get_option("skynet", "top", 5))
-            groupids = self.get_openstack_hostgroups()
-            filters = {"groupids": groupids}
-            search_key = {"key_": "system.cpu.util[,idle]"}
-            total_items = self.get_item_by_filters(filters, search_key)
-            total_cpus = self._get_item_values(total_items)
-            if len(total_cpus) > top:
-                sorted_memory_usage = sorted(total_cpus,
-                                             key=lambda i: i[1])[:top]
-            else:
+            total_items = self.stages.get(
+                "zabbix_items[system.cpu.util[,idle]]")
+            # the least idle cpu first
+            selector = utils.TopK({"top": (top, False)})
+            for hostid, idle in self._get_item_values(total_items):
+                selector.push(idle, hostid)
+            if selector.count <= top:
                 LOG.warning("Total num of openstack physical host %d is less "
-                            "then top(%d)" % (len(total_cpus), top))
-                sorted_memory_usage = sorted(total_cpus,
-                                             key=lambda i: i[1])
-            hostid_value_map = {}
-            top_result = []
-            for i in sorted_memory_usage:
-                hostid_value_map[i[0]] = i[1]
-            hosts = self.get_all_hosts({
-                        "hostids":
-                        hostid_value_map.keys()})['result']
-            top_result = [{
-                host['host']:
-                round((100 - hostid_value_map[host['hostid']]),
-                      4)} for host in hosts]
-            top_result.sort(cmp=lambda x, y: cmp(x, y),
-                            key=lambda x: x.values()[0])
+                            "then top(%d)" % (selector.count, top))
+            ranked = selector.result("top")
+            names = self.get_host_names([hostid for _, hostid in ranked])
+            # ASC order of cpu util
+            top_result = [{names[hostid]: round((100 - idle), 4)}
+                          for idle, hostid in reversed(ranked)
+                          if hostid in names]
             return top_result
         except Exception as e:
             LOG.error("Failed to get openstack cluster top%d memory usage,"
                       "error message: %s" % (top, e.message))
             return []
 
-    def _get_all_instances(self, nv_client):
-        search_opts = {'all_tenants': True}
-        vms = nv_client.servers.list(search_opts=search_opts)
-        return vms
+    def iter_servers(self, nv_client, search_opts=None):
+        """Yield the nova instances of all tenants page by page
+
+        Pages of nova_page_size instances are requested by limit/marker,
+        the raw server dicts are projected to VMRecord(id, name, status)
+        as each page arrives, novaclient Server objects are never built.
+        Nova has no field selection, the detailed listing is needed for
+        the status.
+        """
+        query = {"all_tenants": 1, "limit": self.nova_page_size}
+        query.update(search_opts or {})
+        while True:
+            _resp, body = nv_client.client.get(
+                "/servers/detail?%s" % urllib.urlencode(sorted(query.items())))
+            servers = body.get("servers", [])
+            for server in servers:
+                yield VMRecord(server["id"], server["name"],
+                               server["status"])
+            # nova links the next page when there may be more
+            if not servers or not any(link.get("rel") == "next"
+                                      for link in body.get("servers_links",
+                                                           [])):
+                break
+            query["marker"] = servers[-1]["id"]
 
     def create_vms_total(self):
-        global VMS_CACHED
-        nv_client = self.osk_clients.nv_client
         try:
-            instances = self._get_all_instances(nv_client)
+            inventory = self.stages.get("nova_servers")
         except Exception as e:
             LOG.error("Failed to get openstack all vms,"
                       "error message: %s" % e.message)
@@ -441,66 +1336,34 @@ class ZabbixController(ZabbixBase):
                 "off_count": 0,
                 "paused_count": 0
             }
-        total_count = len(instances)
-        error_count = 0
-        off_count = 0
-        paused_count = 0
-        active_vms = list()
-        for i in instances:
-            if i.status == "ACTIVE":
-                active_vms.append(i.id)
-                if i.id not in VMS_CACHED:
-                    VMS_CACHED[i.id] = i.name
-            elif i.status == "ERROR":
-                error_count += 1
-            elif i.status == "SHUTOFF":
-                off_count += 1
-            elif i.status == "SUSPENDED":
-                paused_count += 1
-        if not VMS_CACHED.get("ACTIVE_VMS"):
-            VMS_CACHED['ACTIVE_VMS'] = active_vms
+        counts = inventory.status_counts()
         return {
-            "total_count": total_count,
-            "active_count": len(active_vms),
-            "error_count": error_count,
-            "off_count": off_count,
-            "paused_count": paused_count
+            "total_count": len(inventory),
+            "active_count": counts.get("ACTIVE", 0),
+            "error_count": counts.get("ERROR", 0),
+            "off_count": counts.get("SHUTOFF", 0),
+            "paused_count": counts.get("SUSPENDED", 0)
             }
 
-    def _get_hypervisor_list_details(self, item):
-        global HYPERVISOR_DETAILS
+    def _get_hypervisor_usage(self, item):
         try:
-            HYPERVISOR_DETAILS = self.osk_clients.nv_client.\
-                hypervisors.list(detailed=True)
+            return self.stages.get("nova_hypervisor_usage")[item]
         except Exception as e:
             LOG.error("Failed to get openstack compute hypervisors,"
                       "skip to poll openstack vms %s usage,"
                       "error message: %s" % (item, e.message))
+            return None
 
     def create_vms_memory_usage(self):
-        global HYPERVISOR_DETAILS
-        if not HYPERVISOR_DETAILS:
-            self._get_hypervisor_list_details("memory")
-            # Failed to get nova hypervisor details
-            if not HYPERVISOR_DETAILS:
-                return {
-                    "used_memory_mb": 0,
-                    "total_memory_mb": 0,
-                    "used_memory_ratio": 0.0
-                }
-        try:
-            (total, used, ratio) = \
-                utils.calculate_items_usage(
-                HYPERVISOR_DETAILS,
-                "memory")
-        except Exception as e:
-            LOG.error("Skip to poll openstack vms memory usage,"
-                      "error message: %s" % e.message)
+        usage = self._get_hypervisor_usage("memory")
+        # Failed to get nova hypervisor usage
+        if usage is None:
             return {
                 "used_memory_mb": 0,
                 "total_memory_mb": 0,
                 "used_memory_ratio": 0.0
             }
+        (total, used, ratio) = usage
         return {
             "used_memory_mb": int(used),
             "total_memory_mb": int(total),
@@ -508,52 +1371,45 @@ class ZabbixController(ZabbixBase):
         }
 
     def create_vms_vcpu_usage(self):
-        global HYPERVISOR_DETAILS
-        if not HYPERVISOR_DETAILS:
-            self._get_hypervisor_list_details("vcpu")
-            # Failed to get nova hypervisor details
-            if not HYPERVISOR_DETAILS:
-                return {
-                    "used_vcpus_used": 0,
-                    "total_vcpus_total": 0,
-                    "used_vcpus_ratio": 0.0
-                }
-        try:
-            (total, used, ratio) = \
-                utils.calculate_items_usage(
-                HYPERVISOR_DETAILS,
-                "vcpu")
-        except Exception as e:
-            LOG.error("Skip to poll openstack vms vcpu usage,"
-                      "error message: %s" % e.message)
+        usage = self._get_hypervisor_usage("vcpu")
+        # Failed to get nova hypervisor usage
+        if usage is None:
             return {
                 "used_vcpus_used": 0,
                 "total_vcpus_total": 0,
                 "used_vcpus_ratio": 0.0
             }
+        (total, used, ratio) = usage
         return {
             "used_vcpus_used": used,
             "total_vcpus_total": int(total),
             "used_vcpus_ratio": ratio
         }
 
+    def create_vms_disk_usage(self):
+        usage = self._get_hypervisor_usage("disk")
+        # Failed to get nova hypervisor usage
+        if usage is None:
+            return {
+                "used_disk_gb": 0,
+                "total_disk_gb": 0,
+                "used_disk_ratio": 0.0
+            }
+        (total, used, ratio) = usage
+        return {
+            "used_disk_gb": int(used),
+            "total_disk_gb": int(total),
+            "used_disk_ratio": ratio
+        }
+
     def get_vms_top_metric(self, metric, top=5, windows=3):
-        global VMS_CACHED
-        if not VMS_CACHED:
-            try:
-                nv_client = self.osk_clients.nv_client
-                instances = self._get_all_instances(nv_client)
-            except Exception as e:
-                LOG.error("Failed to get openstack all vms,"
-                          "error message: %s" % e.message)
-                return []
-            active_vms = list()
-            for vm in instances:
-                if vm.status == "ACTIVE":
-                    active_vms.append(vm.id)
-                VMS_CACHED[vm.id] = vm.name
-            VMS_CACHED['ACTIVE_VMS'] = active_vms
-        resources = VMS_CACHED['ACTIVE_VMS']
+        try:
+            inventory = self.stages.get("nova_servers")
+        except Exception as e:
+            LOG.error("Failed to get openstack all vms,"
+                      "error message: %s" % e.message)
+            return []
+        resources = inventory.ids("ACTIVE")
         sample_filter = {
             "resource": resources,
             "meter": metric,
@@ -567,36 +1423,25 @@ class ZabbixController(ZabbixBase):
         }
         try:
             top = int(self.conf.get_option("skynet", "top", 5))
-            response = self.mongo_handler.get_meter_statistics(
+            statistics = self.mongo_handler.iter_meter_statistics(
                 sample_filter)
-            cache_result = {}
-            for stas in response:
-                if stas.resource_id not in cache_result:
-                    cache_result[stas.resource_id] = stas.avg
+            # Statistics come in timestamp DESC order, only the latest
+            # one of every vm is taken into account
+            seen = set()
+            selector = utils.TopK({"top": (top, True)})
+            for stas in statistics:
+                if stas.resource_id in seen:
+                    continue
+                seen.add(stas.resource_id)
+                if inventory.name(stas.resource_id) is None:
+                    # Maybe this intance is deleted
+                    LOG.warning("Intance with id %s may be deleted"
+                                % stas.resource_id)
+                    continue
+                selector.push(float(stas.avg), stas.resource_id)
             # DESC order
-            top_vms = copy.copy(cache_result.items())
-            top_vms.sort(
-                key=lambda x: x[1],
-                cmp=lambda x, y: cmp(float(y), float(x)))
-            result = list()
-            if len(top_vms) > top:
-                for rsc in top_vms:
-                    try:
-                        if len(result) >= top:
-                            break
-                        rs = {VMS_CACHED[rsc[0]]: rsc[1]}
-                        result.append(rs)
-                    except Exception:
-                        # Maybe this intance is deleted
-                        LOG.warning("Intance with id %s may be deleted"
-                                    % rsc[0])
-            else:
-                LOG.warning("Total num of openstack nova vms %d is less than "
-                            "top(%d)" % (len(top_vms), top))
-                result.extend(
-                    [{VMS_CACHED[rsc[0]]:rsc[1]} for rsc in top_vms]
-                )
-            cache_result.clear()
+            result = [{inventory.name(rsc): avg}
+                      for avg, rsc in selector.result("top")]
             if len(result) < top:
                 LOG.warning("Total num of openstack nova vms %d is less than "
                             "top(%d)" % (len(result), top))
@@ -613,11 +1458,8 @@ class ZabbixController(ZabbixBase):
         return self.get_vms_top_metric("cpu_util", 5, 3)
 
     def create_alarms_total(self):
-        def _get_all_alarms(clm_client):
-            return clm_client.alarms.list()
-        clm_client = self.osk_clients.clm_client
         try:
-            alarms = _get_all_alarms(clm_client)
+            alarms = self.stages.get("ceilometer_alarms")
         except Exception as e:
             LOG.error("Failed to get all ceilometer alarms,"
                       "error message: %s" % e.message)